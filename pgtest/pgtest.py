@@ -24,17 +24,22 @@
 
 from __future__ import print_function
 from contextlib import closing
+import atexit
+import errno
 import os
 import re
 import glob
+import select
 import shutil
 import socket
+import stat
 import subprocess
 import sys
 import tempfile
+import threading
+import functools
 import numbers
 import time
-import datetime
 
 __all__ = ('PGTest', 'is_executable', 'which', 'is_server_running', 'is_valid_cluster_dir', 'is_valid_db_object_name',
            'is_valid_port')
@@ -48,8 +53,56 @@ try:
 except NameError:
     FileNotFoundError = IOError
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows
+
 import pg8000
 
+# Directories searched (in order) for PostgreSQL executables which are not on
+# the PATH. Versioned directories are searched newest first.
+PG_BINDIR_GLOBS = (
+    '/usr/lib/postgresql/*/bin',  # Debian/Ubuntu, as in Debian's PgCommon.pm
+    '/usr/pgsql-*/bin',           # RHEL/Fedora PGDG packages
+    '/usr/local/pgsql/bin',       # default for builds from source
+    '/opt/homebrew/bin',          # Homebrew on Apple silicon
+    '/usr/local/bin',
+)
+
+# Keyword arguments for every pg_ctl Popen call. With an absolute executable
+# path and no cwd/preexec_fn, close_fds=False lets CPython 3.8+ spawn via
+# posix_spawn() (vfork+exec) instead of fork+exec. Nothing leaks into the
+# child since Python 3 file descriptors are non-inheritable by default.
+_SPAWN_KWARGS = {'stdin': subprocess.DEVNULL, 'close_fds': False}
+
+# Options passed through to postgres by PGTest, as the single -o argument to
+# pg_ctl start. Durability is pointless for a throwaway cluster, so fsync (-F),
+# synchronous commits and full page writes are all turned off. The unix socket
+# directory is only set where postgres listens on unix sockets
+_POSTGRES_OPTS = ('-F -p {port} -c logging_collector=off '
+                  '-c synchronous_commit=off -c full_page_writes=off' +
+                  ('' if sys.platform.startswith('win') else
+                   ' -k {unix_socket}'))
+
+# The FICLONE ioctl from <linux/fs.h>, which makes a copy-on-write clone of a
+# file on filesystems which support reflinks (e.g. btrfs and XFS)
+_FICLONE = 0x40049409
+
+# Postgres identifiers: letters, digits and underscores, not starting with a
+# digit and without the reserved 'pg_' prefix
+_DB_OBJECT_NAME_RE = re.compile(r'\A(?!pg_)[a-zA-Z_][a-zA-Z0-9_]*\Z')
+
+# Ports automatically chosen for PGTest instances in this process which are
+# still in use. See _reserve_unused_port()
+_ALLOCATED_PORTS = set()
+_ALLOCATED_PORTS_LOCK = threading.Lock()
+
+# Pristine clusters which new PGTest clusters are copied from, keyed by
+# (pg_ctl executable, username). See _get_template_cluster()
+_TEMPLATE_CLUSTERS = {}
+_TEMPLATE_CLUSTERS_LOCK = threading.Lock()
+
 
 class TimeoutError(BaseException):
     def __init__(self, message):
@@ -57,72 +110,104 @@ class TimeoutError(BaseException):
 
 def is_executable(file_path):
     """Checks whether file_path points to executable file."""
-    return file_path and os.path.isfile(file_path) and os.access(file_path, os.X_OK)
+    if not file_path:
+        return False
+    # A single stat answers both "is it a file" and "is it executable"
+    try:
+        mode = os.stat(file_path).st_mode
+    except OSError:
+        return False
+    return stat.S_ISREG(mode) and bool(mode & (stat.S_IXUSR | stat.S_IXGRP |
+                                               stat.S_IXOTH))
+
+def _bindir_version(path):
+    """Sort key ordering versioned bin directories by version number, e.g.
+    /usr/lib/postgresql/12/bin after /usr/lib/postgresql/9.6/bin
+    """
+    return tuple(int(part) for part in re.findall(r'\d+', path))
 
+@functools.lru_cache(maxsize=None)
+def _pg_bindirs():
+    """Returns the directories matching `PG_BINDIR_GLOBS`, in search order,
+    so the filesystem is only globbed once per process
+    """
+    bindirs = []
+    for pattern in PG_BINDIR_GLOBS:
+        bindirs.extend(sorted(glob.glob(pattern), key=_bindir_version,
+                              reverse=True))
+    return tuple(bindirs)
+
+@functools.lru_cache(maxsize=1)
+def _path_entries(path_env):
+    """Splits a $PATH value into its directories, stripping any quotes. Keyed
+    on the value itself so a changed $PATH is split afresh
+    """
+    return tuple(path.strip('"') for path in path_env.split(os.pathsep))
+
+def _exe_names(in_file):
+    """Returns the file names to try, in order, when looking for in_file. On
+    Windows these are in_file with each of the $PATHEXT extensions, unless it
+    already has one; elsewhere executables have no extension
+    """
+    if not sys.platform.startswith('win'):
+        return (in_file,)
+    extensions = os.environ.get('PATHEXT', '.COM;.EXE;.BAT;.CMD').lower()
+    extensions = [ext for ext in extensions.split(os.pathsep) if ext]
+    if os.path.splitext(in_file)[1].lower() in extensions:
+        return (in_file,)
+    return tuple(in_file + ext for ext in extensions) + (in_file,)
+
+@functools.lru_cache(maxsize=None)
 def which(in_file):
     """Finds an executable program in the system and returns the program name
 
     Accepts filenames with or without full paths with or without file
-    extensions. If running on unix, /usr/lib/postgresql will be searched and
-    the `locate` commmand will be used as a last resort to find the
-    executable.
+    extensions. If running on unix and the program is not on the PATH, the
+    usual PostgreSQL install locations in `PG_BINDIR_GLOBS` are searched.
+
+    Results are cached for the lifetime of the process, so repeated lookups
+    (e.g. one per PGTest instance) don't rescan the filesystem. Call
+    `_clear_exe_cache()` if executables are moved or $PATH is changed.
 
     Args:
         in_file - str, program name or path to find
 
     Returns:
-        file_path - str, normalised path to file found
+        file_path - str, normalised absolute path to file found
         
     Raises:
         FileNotFoundError, if no executable file not found
     """
     if not isinstance(in_file, basestring):
         raise TypeError('file must be a valid string')
-    path_no_ext, _ = os.path.splitext(in_file)
-    path_with_exe = path_no_ext + '.exe'
+    names = _exe_names(in_file)
 
     # Look for the exe at the path supplied
-    if os.path.split(path_no_ext)[0]:
-        if is_executable(in_file):
-            return os.path.normpath(in_file)
-        elif is_executable(path_with_exe):
-            return os.path.normpath(path_with_exe)
+    if os.path.dirname(in_file):
+        candidates = names
     # Search inside the PATH
     else:
-        for path in os.environ['PATH'].split(os.pathsep):
-            file_path = os.path.join(path.strip('"'), in_file)
-            file_path_with_exe = os.path.join(path.strip('"'), path_with_exe)
-            if is_executable(file_path_with_exe):
-                return os.path.normpath(file_path_with_exe)
-            elif is_executable(file_path):
-                return os.path.normpath(file_path)
+        candidates = (os.path.join(path, name)
+                      for path in _path_entries(os.environ.get('PATH', ''))
+                      for name in names)
+    for file_path in candidates:
+        if is_executable(file_path):
+            return os.path.abspath(file_path)
 
     if not sys.platform.startswith('win'):
-        # first, search default locations, inspired by Debian's PgCommon.pm
-        try:
-            pg_ctls = {float(re.search(r'postgresql/([\d\.]+)/bin', p).group(1)):
-                    p for p in glob.glob('/usr/lib/postgresql/*/bin/' + in_file)}
-            file_path = pg_ctls[max(pg_ctls)]
+        for bindir in _pg_bindirs():
+            file_path = os.path.join(bindir, in_file)
             if is_executable(file_path):
-                return os.path.normpath(file_path)
+                return os.path.abspath(file_path)
 
-        except (AttributeError, ValueError):
-            # AttributeError occurs if re.search returns None,
-            # ValueError if pg_ctls is empty
-            pass
+        raise FileNotFoundError("'{}' could not be found.".format(in_file))
 
-        # otherwise fall back to `locate` command
-        try:
-            exact_file_regex = '/' + in_file + '$'
-            locate_cmd = ['locate', '-r', exact_file_regex]
-            results = subprocess.check_output(locate_cmd)
-            for file_path in results.decode('utf-8').split('\n'):
-                if is_executable(file_path):
-                    return os.path.normpath(file_path)
-        except (FileNotFoundError, subprocess.CalledProcessError):
-            pass
 
-        raise FileNotFoundError("'{}' could not be found.".format(in_file))
+def _clear_exe_cache():
+    """Clears the results cached by `which`
+    """
+    which.cache_clear()
+    _pg_bindirs.cache_clear()
 
 def is_valid_port(port):
     """Checks a port number to check if it is within the valid range
@@ -138,6 +223,52 @@ def is_valid_port(port):
     return 1024 < port < 65535
 
 
+def _reserve_unused_port(allocate=False):
+    """Binds a socket to an unused port and returns it. The port stays
+    reserved until the socket is closed, so close it just before your process
+    binds the port.
+
+    Ports allocated to other PGTest instances in this process are skipped,
+    since the kernel doesn't see them as in use between the reserving socket
+    being closed and the server binding them.
+
+    Args:
+        allocate - bool, record the port as allocated until it is passed to
+                   `_free_allocated_port`
+
+    Returns:
+        sock - socket.socket, bound to an as-yet unused, valid port
+
+    Raises:
+        RuntimeError, if no valid port could be bound
+    """
+    for _ in range(16):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            # Lets the server bind the port as soon as this socket is closed
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            # 0 binds to unused socket
+            sock.bind(('127.0.0.1', 0))
+            _, port = sock.getsockname()
+        except:
+            sock.close()
+            raise
+        with _ALLOCATED_PORTS_LOCK:
+            if is_valid_port(port) and port not in _ALLOCATED_PORTS:
+                if allocate:
+                    _ALLOCATED_PORTS.add(port)
+                return sock
+        sock.close()
+    raise RuntimeError('Could not bind an unused port')
+
+
+def _free_allocated_port(port):
+    """Allows a port allocated by `_reserve_unused_port` to be handed out again
+    """
+    with _ALLOCATED_PORTS_LOCK:
+        _ALLOCATED_PORTS.discard(port)
+
+
 def bind_unused_port():
     """Gets an unused port number.
 
@@ -149,13 +280,8 @@ def bind_unused_port():
     Returns:
         port - int, an as-yet unused port
     """
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    # 0 binds to unused socket
-    sock.bind(('localhost', 0))
-    _, port = sock.getsockname()
-    while not is_valid_port(port):
-        port = bind_unused_port()
-    sock.close()
+    with closing(_reserve_unused_port()) as sock:
+        _, port = sock.getsockname()
     return port
 
 
@@ -170,53 +296,130 @@ def is_valid_db_object_name(name):
     """
     if not isinstance(name, basestring):
         raise TypeError('name must be a valid string')
-    pattern = re.compile('^(?!pg_)[a-zA-Z_][a-zA-Z0-9_]*$')
-    if not re.match(pattern, name):
-        return False
-    return True
+    return _DB_OBJECT_NAME_RE.match(name) is not None
 
 
 def is_server_running(path):
     """Checks whether a server process is running in a given cluster path
 
+    On unix this reads the postmaster pid from `postmaster.pid` and checks
+    that the process is alive, rather than running `pg_ctl status`.
+
     Args:
-        pg_ctl_exe - str, path to pg_ctl executable
         path - str, path to cluster directory
 
     Returns:
         bool, whether or not a server is running
     """
-    pg_ctl_exe = which('pg_ctl')
-    cmd = '"{pg_ctl}" status -D "{path}"'.format(pg_ctl=pg_ctl_exe, path=path)
-    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE)
-    out, _ = proc.communicate()
-    if out.decode('utf-8').strip() == 'pg_ctl: no server running':
+    if sys.platform.startswith('win'):
+        # os.kill() terminates the process on Windows, so ask pg_ctl instead
+        pg_ctl_exe = which('pg_ctl')
+        cmd = [pg_ctl_exe, 'status', '-D', path]
+        out = subprocess.run(cmd, stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL, **_SPAWN_KWARGS).stdout
+        return out.strip() != b'pg_ctl: no server running'
+
+    try:
+        with open(os.path.join(path, 'postmaster.pid'), 'r') as handle:
+            pid = int(handle.readline())
+    except (OSError, ValueError):
         return False
-    else:
-        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # the process exists but belongs to another user
+    return True
 
 
 def is_valid_cluster_dir(path):
     """Checks whether a given path is a valid postgres cluster
 
     Args:
-        pg_ctl_exe - str, path to pg_ctl executable
         path - str, path to directory
 
     Returns:
         bool, whether or not a directory is a valid postgres cluster
     """
-    pg_controldata_exe = which('pg_controldata')
-    cmd = '"{pg_controldata}" "{path}"'.format(
-        pg_controldata=pg_controldata_exe, path=path)
-    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE)
-    _, err = proc.communicate()
-    if 'No such file or directory' in err.decode('utf-8'):
-        return False
-    else:
-        return True
+    return os.path.isfile(os.path.join(path, 'PG_VERSION'))
+
+
+def _make_clone_file():
+    """Returns a copy function for one shutil.copytree() call, which clones
+    files as reflinks where the filesystem supports it so no data is copied,
+    and falls back to a regular copy otherwise.
+
+    Once the filesystem has refused a clone, the rest of the files are copied
+    straight away, so that filesystems without reflinks (e.g. ext4 and tmpfs)
+    don't pay for a failed clone per file.
+
+    Returns:
+        clone_file - function, taking the src and dst paths of a file
+    """
+    state = {'reflink': fcntl is not None and sys.platform.startswith('linux')}
+
+    def clone_file(src, dst):
+        if state['reflink']:
+            try:
+                with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                    fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+                shutil.copystat(src, dst)
+                return dst
+            except OSError as exc:
+                if exc.errno in (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL,
+                                 errno.ENOTTY):
+                    state['reflink'] = False
+        return shutil.copy2(src, dst)
+
+    return clone_file
+
+
+def _init_cluster(pg_ctl_exe, path, username):
+    """Creates a brand new cluster with initdb
+
+    Args:
+        pg_ctl_exe - str, path to pg_ctl executable
+        path - str, path to the cluster directory to create
+        username - str, username for default database superuser
+    """
+    # -N (--no-sync) skips fsyncing the new files, which a throwaway cluster
+    # doesn't need
+    cmd = [pg_ctl_exe, 'initdb', '-D', path,
+           '-o', '-U {username} -A trust -N'.format(username=username)]
+
+    err = subprocess.run(cmd, stdout=subprocess.DEVNULL,
+                         stderr=subprocess.PIPE, **_SPAWN_KWARGS).stderr
+    if err:
+        raise IOError(err)
+
+
+def _get_template_cluster(pg_ctl_exe, username):
+    """Returns a pristine cluster to copy new PGTest clusters from, running
+    initdb the first time it is needed in this process. Copying a cluster is
+    much quicker than running initdb for every PGTest instance.
+
+    The template is never started, and it is removed when the interpreter
+    exits. This is safe to call from several threads at once.
+
+    Args:
+        pg_ctl_exe - str, path to pg_ctl executable
+        username - str, username for default database superuser
+
+    Returns:
+        path - str, path to the template cluster directory
+    """
+    key = (pg_ctl_exe, username)
+    # Held while initdb runs so that concurrently created instances wait for
+    # the one template rather than each running initdb
+    with _TEMPLATE_CLUSTERS_LOCK:
+        if key not in _TEMPLATE_CLUSTERS:
+            base_dir = tempfile.mkdtemp(prefix='pgtest_template_')
+            atexit.register(shutil.rmtree, base_dir, ignore_errors=True)
+            path = os.path.join(base_dir, 'data')
+            _init_cluster(pg_ctl_exe, path, username)
+            _TEMPLATE_CLUSTERS[key] = path
+        return _TEMPLATE_CLUSTERS[key]
 
 
 # pylint: disable=too-many-instance-attributes
@@ -236,6 +439,8 @@ class PGTest(object):
            Note: PostgreSQL may require a minimum number of allowed connections
              (e.g. 11 connections with PostgreSQL 10 on Ubuntu 18.04 or 14
              connections with PostgresSQL 11 on Ubuntu 19.04)
+        postgres_opts - str, extra command line options for postgres, added
+           after PGTest's own, e.g. '-c checkpoint_timeout=3600'
 
     Attributes:
         PGTest.port - int, port number bound by PGTest
@@ -286,9 +491,8 @@ class PGTest(object):
     # pylint: disable=too-many-arguments
     def __init__(self, username='postgres', port=None, log_file=None,
                  no_cleanup=False, copy_cluster=None, base_dir=None,
-                 pg_ctl=None, max_connections=None):
+                 pg_ctl=None, max_connections=None, postgres_opts=None):
         self._database = 'postgres'
-        self._proc_start = None
 
         assert is_valid_db_object_name(username), (
             'Username must contain only letters and/or numbers')
@@ -312,13 +516,21 @@ class PGTest(object):
         if port:
             assert is_valid_port(port), (
                 'Port is not between 1024 and 65535: {port}').format(port=port)
-            self._port = port
-        else:
-            self._port = bind_unused_port()
 
         if base_dir:
             assert os.path.exists(base_dir), (
                 'Directory does not exist: {path}').format(path=base_dir)
+
+        self._no_cleanup = no_cleanup
+        assert max_connections is None or isinstance(max_connections, numbers.Integral), (
+            'Maximum number of connections must be an integer.')
+        self._max_connections = max_connections
+
+        assert postgres_opts is None or isinstance(postgres_opts, str), (
+            'Postgres options must be a string.')
+        self._postgres_opts = postgres_opts
+
+        if base_dir:
             self._base_dir = base_dir
         else:
             self._base_dir = tempfile.mkdtemp()
@@ -335,14 +547,24 @@ class PGTest(object):
         else:
             self._listen_socket_dir = None
 
-        self._no_cleanup = no_cleanup
-        assert max_connections is None or isinstance(max_connections, numbers.Integral), (
-            'Maximum number of connections must be an integer.')
-        self._max_connections = max_connections
+        # Socket holding our automatically chosen port until the server
+        # starts. Only reserved once every argument has been checked, since
+        # the port is freed by _cleanup()
+        self._port_holder = None
+        self._port_allocated = False
+        if port:
+            self._port = port
+        else:
+            try:
+                self._port_holder = _reserve_unused_port(allocate=True)
+            except:
+                self._cleanup()
+                raise
+            _, self._port = self._port_holder.getsockname()
+            self._port_allocated = True
 
         self._create_dirs()
         self._init_base_dir()
-        self._set_dir_permissions()
         self._start_server()
 
     def __enter__(self):
@@ -431,45 +653,52 @@ class PGTest(object):
         """Start the portgres server and wait for it to respond before
         continuing. If an exception is raised, cleanup
         """
-        if sys.platform.startswith('win'):
-            socket_opt = ''
-        else:
-            socket_opt = '-k {unix_socket}'.format(
-                unix_socket=self._listen_socket_dir)
-
-        if self._max_connections is None:
-            connections_opt = ''
-        else:
-            connections_opt = '-N {max_connections}'.format(max_connections=self._max_connections)
-
-        cmd = ('"{pg_ctl}" start -D "{cluster}" -l "{log_file}" -o "-F -d 1 '
-               '-p {port} -c logging_collector=off '
-               '{connections_opt} {socket_opt}"').format(pg_ctl=self._pg_ctl_exe,
-                                            cluster=self._cluster,
-                                            log_file=self._log_file,
-                                            port=self._port,
-                                            connections_opt=connections_opt,
-                                            socket_opt=socket_opt)
+        timeout = 5
         try:
-            self._proc_start = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
-                                                stderr=subprocess.PIPE)
-            self._wait_for_server_ready(5)
+            postgres_opts = _POSTGRES_OPTS.format(
+                port=self._port, unix_socket=self._listen_socket_dir)
+            if self._max_connections is not None:
+                postgres_opts += ' -N {max_connections}'.format(
+                    max_connections=self._max_connections)
+            if self._postgres_opts:
+                postgres_opts += ' ' + self._postgres_opts
+
+            # -w makes pg_ctl wait until the server accepts connections, or
+            # fail after -t seconds. It also waits on the postmaster it
+            # launched, so a server which exits during startup fails at once
+            cmd = [self._pg_ctl_exe, 'start', '-w', '-t', str(timeout),
+                   '-D', self._cluster, '-l', self._log_file,
+                   '-o', postgres_opts]
+            self._release_port()
+            # pg_ctl's output is never read, so don't give it a pipe which
+            # could fill up and block it; failures are diagnosed from the log
+            returncode = subprocess.run(cmd, stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.DEVNULL,
+                                        timeout=timeout + 5,
+                                        **_SPAWN_KWARGS).returncode
+            if returncode:
+                raise RuntimeError('pg_ctl start failed with exit code '
+                                   '{code}'.format(code=returncode))
+            # Belt and braces: pg_ctl has already waited for the server, so
+            # this normally succeeds on the first probe
+            self._wait_for_server_ready(timeout)
         except:
             print('Server failed to start')
-            print(self.log_file_contents)
+            # pg_ctl may not have got as far as creating the log
+            if os.path.exists(self._log_file):
+                print(self.log_file_contents)
             self._cleanup()
             raise
 
     def _stop_server(self):
         """Stop the postgres server. If an exception is raised, cleanup
         """
-        cmd = '"{pg_ctl}" stop -m fast -D {cluster}'.format(
-            pg_ctl=self._pg_ctl_exe, cluster=self._cluster)
+        cmd = [self._pg_ctl_exe, 'stop', '-m', 'fast', '-D', self._cluster]
 
         try:
-            proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE)
-            _, err = proc.communicate()
+            err = subprocess.run(cmd, stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.PIPE,
+                                 **_SPAWN_KWARGS).stderr
             if err:
                 raise RuntimeError(err)
         except:
@@ -481,9 +710,6 @@ class PGTest(object):
         """Stop the server and cleanup the direcotries created
         """
         self._stop_server()
-        if self._proc_start is not None:
-            self._proc_start.communicate() # Ensures all file descriptors are closed
-            self._proc_start = None
         self._cleanup()
 
     def _cleanup(self):
@@ -491,29 +717,37 @@ class PGTest(object):
         this instance. If not cleaned up for any reason, no big deal since by
         default the directories are created in the users own temp directory
         """
+        self._release_port()
+        if self._port_allocated:
+            _free_allocated_port(self._port)
+            self._port_allocated = False
         if not self._no_cleanup:
             shutil.rmtree(self._base_dir, ignore_errors=True)
 
+    def _release_port(self):
+        """Closes the socket reserving this instance's port, if any, so that
+        the server can bind it
+        """
+        if self._port_holder is not None:
+            self._port_holder.close()
+            self._port_holder = None
+
     def _init_base_dir(self):
-        """Initiates the base directory and creates a cluster, either brand new
-        or by copying the cluster defined by the user
+        """Initiates the base directory and creates a cluster by copying either
+        the cluster defined by the user or a freshly initialised template
         """
         try:
             if self._copy_cluster:
-                shutil.rmtree(self._cluster)
-                shutil.copytree(self._copy_cluster, self._cluster)
+                source = self._copy_cluster
             else:
-                cmd = ('"{pg_ctl}" initdb -D "{cluster}" -o "-U {username} -A '
-                       'trust"').format(pg_ctl=self._pg_ctl_exe,
-                                        cluster=self._cluster,
-                                        username=self._username)
-
-                proc = subprocess.Popen(cmd, shell=True,
-                                        stdout=subprocess.PIPE,
-                                        stderr=subprocess.PIPE)
-                _, err = proc.communicate()
-                if err:
-                    raise IOError(err)
+                source = _get_template_cluster(self._pg_ctl_exe,
+                                               self._username)
+            shutil.rmtree(self._cluster)
+            shutil.copytree(source, self._cluster,
+                            copy_function=_make_clone_file())
+            # copytree gives the cluster the source's mode, and postgres
+            # refuses to start unless only the owner can read it
+            os.chmod(self._cluster, 0o700)
             assert is_valid_cluster_dir(self._cluster), (
                 'Failed to create cluster: {path}').format(path=self._cluster)
         except:
@@ -521,46 +755,112 @@ class PGTest(object):
             raise
 
     def _create_dirs(self):
-        """Creates the directories required by postgres to create the cluster
+        """Creates the directories required by postgres to create the cluster,
+        readable by the current user only. The cluster directory itself is
+        replaced, and its mode set, by _init_base_dir()
         """
         try:
             for path in (self._base_dir, self._cluster,
                          self._listen_socket_dir):
-                if path and not os.path.exists(path):
-                    os.makedirs(path)
+                if path is None:
+                    continue
+                os.makedirs(path, mode=0o700, exist_ok=True)
+                # The makedirs mode is subject to the umask and is not applied
+                # to directories which already exist
+                os.chmod(path, 0o700)
         except:
             self._cleanup()
             raise
 
-    def _set_dir_permissions(self):
-        """Sets the directory permissions to 777
+    def _is_server_listening(self):
+        """Cheaply tests if the server has opened its listen sockets, without
+        a full postgres handshake
         """
         try:
-            for path in (self._base_dir, self._cluster,
-                         self._listen_socket_dir):
-                if path and os.path.exists(path):
-                    os.chmod(path, 0o700)
-        except:
-            self._cleanup()
-            raise
+            with open(os.path.join(self._cluster, 'postmaster.pid'), 'r') as handle:
+                # The postmaster appends the listen address as the 6th line
+                # once its sockets are open
+                if handle.read().count('\n') < 6:
+                    return False
+        except (OSError, IOError):
+            return False
+        # On unix probe the socket which _is_connection_available() uses, as
+        # the server needn't listen on 127.0.0.1, e.g. when postgres_opts sets
+        # listen_addresses
+        if self._listen_socket_dir:
+            address = os.path.join(self._listen_socket_dir,
+                                   '.s.PGSQL.{port}'.format(port=self._port))
+            family = socket.AF_UNIX
+        else:
+            address = ('127.0.0.1', self._port)
+            family = socket.AF_INET
+        with closing(socket.socket(family, socket.SOCK_STREAM)) as sock:
+            sock.settimeout(0.1)
+            return sock.connect_ex(address) == 0
 
     def _is_connection_available(self):
-        """Tests if the connection to the new cluster is available
+        """Tests if the connection to the new cluster is available. On unix
+        this connects through the server's unix socket to skip the TCP stack
         """
+        if self._listen_socket_dir:
+            kwargs = {'user': self._username,
+                      'database': self._database,
+                      'unix_sock': os.path.join(
+                          self._listen_socket_dir,
+                          '.s.PGSQL.{port}'.format(port=self._port))}
+        else:
+            kwargs = self.dsn
         try:
-            with closing(pg8000.connect(**self.dsn)):
+            with closing(pg8000.connect(**kwargs)):
                 return True
         except pg8000.Error:
             return False
 
+    def _open_postmaster_pidfd(self):
+        """Returns a pidfd for the postmaster process, which becomes readable
+        when the process exits. Returns None if the postmaster hasn't written
+        its pid yet or pidfds aren't supported (they need Linux 5.3+ and
+        Python 3.9+)
+        """
+        if not hasattr(os, 'pidfd_open'):
+            return None
+        try:
+            with open(os.path.join(self._cluster, 'postmaster.pid'), 'r') as handle:
+                pid = int(handle.readline())
+            return os.pidfd_open(pid)
+        except (OSError, ValueError):
+            return None
+
     def _wait_for_server_ready(self, wait):
-        """Sleep while we have no connection, timing out after `wait` seconds
+        """Sleep while we have no connection, timing out after `wait` seconds.
+        A pg8000 connection is only attempted once the server is listening.
+
+        Polls back off exponentially from 1ms to 20ms. Where supported, waits
+        on a pidfd for the postmaster so that startup fails straight away if
+        it exits, rather than after `wait` seconds
 
         Args:
             wait - int, number of seconds to timeout the connection
         """
-        endtime = datetime.datetime.utcnow() + datetime.timedelta(seconds=wait)
-        while not self._is_connection_available():
-            time.sleep(0.1)
-            if datetime.datetime.utcnow() > endtime:
-                raise TimeoutError('Server failed to start')
+        endtime = time.monotonic() + wait
+        delay = 0.001
+        pidfd = None
+        poller = None
+        try:
+            while not (self._is_server_listening() and
+                       self._is_connection_available()):
+                if time.monotonic() > endtime:
+                    raise TimeoutError('Server failed to start')
+                if pidfd is None:
+                    pidfd = self._open_postmaster_pidfd()
+                    if pidfd is not None:
+                        poller = select.poll()
+                        poller.register(pidfd, select.POLLIN)
+                if poller is None:
+                    time.sleep(delay)
+                elif poller.poll(delay * 1000):
+                    raise RuntimeError('Server exited during startup')
+                delay = min(delay * 2, 0.02)
+        finally:
+            if pidfd is not None:
+                os.close(pidfd)
@@ -1,31 +1,44 @@
 # encoding: utf-8
 import os
 import re
+import stat
 import sys
 import unittest
 
 
+def _stat_mode(path):
+    """Returns the mode of path, or None if it doesn't exist"""
+    try:
+        return os.stat(path).st_mode
+    except OSError:
+        return None
+
+
 class CustomAssertions():
 
     def assertRegexMatch(self, pattern, target, msg=None):
-        comp = re.compile(pattern)
-        if not re.match(comp, target):
+        # pattern may be a string or a compiled pattern
+        if not re.match(pattern, target):
             if not msg:
                 msg = '{!r} does not match pattern {!r}'.format(target, pattern)
             raise AssertionError(msg)
 
     def assertFileExists(self, path):
-        if not os.path.isfile(path):
+        mode = _stat_mode(path)
+        if mode is None or not stat.S_ISREG(mode):
             raise AssertionError('File does not exist: {!r}'.format(path))
 
     def assertDirExists(self, path):
-        if not os.path.isdir(path):
+        mode = _stat_mode(path)
+        if mode is None or not stat.S_ISDIR(mode):
             raise AssertionError('Directory does not exist: {!r}'.format(path))
 
     def assertFileNotExists(self, path):
-        if os.path.isfile(path):
+        mode = _stat_mode(path)
+        if mode is not None and stat.S_ISREG(mode):
             raise AssertionError('File exists: {!r}'.format(path))
 
     def assertDirNotExists(self, path):
-        if os.path.isdir(path):
+        mode = _stat_mode(path)
+        if mode is not None and stat.S_ISDIR(mode):
             raise AssertionError('Directory exists: {!r}'.format(path))
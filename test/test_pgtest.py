@@ -1,7 +1,12 @@
 # encoding: utf-8
 from contextlib import closing
+import errno
 import os
+import random
+import re
 import shutil
+import socket
+import stat
 import subprocess
 import sys
 import tempfile
@@ -19,61 +24,145 @@ try:
 except NameError:
     FileNotFoundError = IOError
 
+URL_RE = re.compile(r'postgresql://\w+@localhost:\d+/\w+')
+
+# pg_ctl executable found once for the whole module. See find_postgres()
+PG_CTL_EXE = None
+
+# Server shared by all tests which only connect to it or read its attributes,
+# so they don't each pay for starting one. Tests of constructor options and
+# cleanup create their own. See get_shared_pg()
+SHARED_PG = None
+
+# The shared server's tests don't write enough to need checkpoints or the
+# background writer
+SHARED_PG_OPTS = ('-c bgwriter_delay=10000 -c bgwriter_lru_maxpages=0 '
+                  '-c checkpoint_timeout=3600')
+
+# pgtest's own template cluster, for tests which need a cluster that isn't
+# running. Copy it before modifying it
+CLUSTER_TEMPLATE = None
+
+def find_postgres():
+    """Finds pg_ctl and the cluster template, the first time a test class
+    needs them. Tests which don't need PostgreSQL never call this, so they
+    run without it installed
+    """
+    global PG_CTL_EXE, CLUSTER_TEMPLATE
+    if CLUSTER_TEMPLATE is None:
+        PG_CTL_EXE = pgtest.which('pg_ctl')
+        CLUSTER_TEMPLATE = pgtest._get_template_cluster(PG_CTL_EXE,
+                                                        'postgres')
+
+def get_shared_pg():
+    """Returns the shared server, starting it the first time a test class
+    needs it
+    """
+    global SHARED_PG
+    find_postgres()
+    if SHARED_PG is None:
+        SHARED_PG = pgtest.PGTest(pg_ctl=PG_CTL_EXE,
+                                  postgres_opts=SHARED_PG_OPTS)
+    return SHARED_PG
+
+def tearDownModule():
+    if SHARED_PG is not None:
+        SHARED_PG.close()
+
+def remove_dir(path):
+    """Removes a directory tree, unless the code under test already removed
+    it. Other errors are raised, rather than leaving the directory behind
+    """
+    if os.path.exists(path):
+        shutil.rmtree(path)
+
+def make_temp_dir(test):
+    """Creates a temporary directory which is removed once the test is over,
+    even if it fails or errors
+    """
+    path = tempfile.mkdtemp()
+    test.addCleanup(remove_dir, path)
+    return path
+
 class TestThirdPartyDrivers(unittest.TestCase):
 
     @classmethod
     def setUpClass(cls):
-        cls.pg = pgtest.PGTest()
-        cls.base_dir = cls.pg._base_dir
+        cls.pg = get_shared_pg()
+        cls.psycopg2_cnxn = psycopg2.connect(**cls.pg.dsn)
+        cls.pg8000_cnxn = pg8000.connect(**cls.pg.dsn)
+        cls.engine = sqlalchemy.create_engine(cls.pg.url)
+        cls.sqlalchemy_cnxn = cls.engine.connect()
 
     @classmethod
     def tearDownClass(cls):
-        cls.pg.close()
+        cls.sqlalchemy_cnxn.close()
+        cls.engine.dispose()
+        cls.pg8000_cnxn.close()
+        cls.psycopg2_cnxn.close()
 
     def test_psycopg2(self):
-        with closing(psycopg2.connect(**self.pg.dsn)) as cnxn:
-            self.assertIsNotNone(cnxn)
+        with closing(self.psycopg2_cnxn.cursor()) as cursor:
+            cursor.execute('SELECT 1')
+            self.assertEqual(cursor.fetchone()[0], 1)
 
     def test_sqlalchemy(self):
-        engine = sqlalchemy.create_engine(self.pg.url)
-        with closing(engine.connect()) as cnxn:
-            self.assertIsNotNone(cnxn)
-        engine.dispose()
+        result = self.sqlalchemy_cnxn.execute(sqlalchemy.text('SELECT 1'))
+        self.assertEqual(result.scalar(), 1)
 
     def test_pg8000(self):
-        with closing(pg8000.connect(**self.pg.dsn)) as cnxn:
-            self.assertIsNotNone(cnxn)
+        cursor = self.pg8000_cnxn.cursor()
+        cursor.execute('SELECT 1')
+        self.assertEqual(cursor.fetchone()[0], 1)
 
 
 class TestPGTestWithParameters(unittest.TestCase, CustomAssertions):
 
+    @classmethod
+    def setUpClass(cls):
+        find_postgres()
+
     def test_cleanup(self):
         with pgtest.PGTest() as pg:
             base_dir = pg._base_dir
             self.assertDirExists(base_dir)
         self.assertDirNotExists(base_dir)
 
+    def test_allocated_port_freed_on_close(self):
+        with pgtest.PGTest() as pg:
+            self.assertIn(pg.port, pgtest._ALLOCATED_PORTS)
+        self.assertNotIn(pg.port, pgtest._ALLOCATED_PORTS)
+
+    def test_allocated_port_freed_on_failure(self):
+        allocated = set(pgtest._ALLOCATED_PORTS)
+        with self.subTest(failure='invalid argument'):
+            with self.assertRaises(AssertionError):
+                pgtest.PGTest(max_connections=3.5)
+            self.assertEqual(pgtest._ALLOCATED_PORTS, allocated)
+        with self.subTest(failure='server start'):
+            with self.assertRaises((RuntimeError, pgtest.TimeoutError)):
+                pgtest.PGTest(postgres_opts='-c not_a_setting=1')
+            self.assertEqual(pgtest._ALLOCATED_PORTS, allocated)
+
     def test_no_cleanup(self):
         with pgtest.PGTest(no_cleanup=True) as pg:
             base_dir = pg._base_dir
+            self.addCleanup(shutil.rmtree, base_dir)
             self.assertDirExists(base_dir)
         self.assertDirExists(base_dir)
-        shutil.rmtree(base_dir, ignore_errors=True)
 
     def test_username_valid(self):
         with pgtest.PGTest(username='my_user') as pg:
             self.assertTrue(pgtest.is_server_running(pg.cluster))
 
     def test_pg_ctl_exe_valid(self):
-        pg_ctl_exe = pgtest.which('pg_ctl')
-        with pgtest.PGTest(pg_ctl=pg_ctl_exe) as pg:
+        with pgtest.PGTest(pg_ctl=PG_CTL_EXE) as pg:
             self.assertTrue(pgtest.is_server_running(pg.cluster))
 
     def test_base_dir_valid(self):
-        temp_dir = tempfile.mkdtemp()
+        temp_dir = make_temp_dir(self)
         with pgtest.PGTest(base_dir=temp_dir) as pg:
             self.assertTrue(pgtest.is_server_running(pg.cluster))
-        shutil.rmtree(temp_dir, ignore_errors=True)
 
     def test_invalid_username_exit(self):
         with self.assertRaises(AssertionError):
@@ -84,10 +173,9 @@ class TestPGTestWithParameters(unittest.TestCase, CustomAssertions):
             pgtest.PGTest(pg_ctl='/not/a/path/pg_ctl')
 
     def test_invalid_copy_cluster_exit(self):
-        temp_dir = tempfile.mkdtemp()
+        temp_dir = make_temp_dir(self)
         with self.assertRaises(AssertionError):
             pgtest.PGTest(copy_cluster=temp_dir)
-        shutil.rmtree(temp_dir, ignore_errors=True)
 
     def test_no_exist_copy_cluster_exit(self):
         with self.assertRaises(AssertionError):
@@ -106,46 +194,61 @@ class TestPGTestWithParameters(unittest.TestCase, CustomAssertions):
             pgtest.PGTest(base_dir='/not/a/path')
 
     def test_copy_data(self):
-        pg_ctl_exe = pgtest.which('pg_ctl')
-        temp_dir = tempfile.mkdtemp()
-        data_dir = os.path.join(temp_dir, 'data')
-        cmd = ('"{pg_ctl}" initdb -D "{cluster}" -o "-U postgres -A trust"'
-               ).format(pg_ctl=pg_ctl_exe, cluster=data_dir)
-        subprocess.check_output(cmd, shell=True)
+        with pgtest.PGTest(copy_cluster=CLUSTER_TEMPLATE) as pg:
+            self.assertTrue(pgtest.is_server_running(pg.cluster))
+        self.assertFalse(pgtest.is_server_running(CLUSTER_TEMPLATE))
+
+    @unittest.skipIf(sys.platform.startswith('win'), 'Unix only')
+    def test_copy_data_readable_by_others(self):
+        data_dir = os.path.join(make_temp_dir(self), 'data')
+        shutil.copytree(CLUSTER_TEMPLATE, data_dir)
+        os.chmod(data_dir, 0o755)
         with pgtest.PGTest(copy_cluster=data_dir) as pg:
             self.assertTrue(pgtest.is_server_running(pg.cluster))
-        shutil.rmtree(temp_dir, ignore_errors=True)
+            self.assertEqual(stat.S_IMODE(os.stat(pg.cluster).st_mode), 0o700)
 
     def test_max_connections_valid(self):
         with pgtest.PGTest(max_connections=12) as pg:
             with psycopg2.connect(**pg.dsn) as connection:
                 with connection.cursor() as cursor:
-                    cursor.execute('SHOW max_connections;')
-                    self.assertEqual(int(list(cursor)[0][0]), 12)
+                    cursor.execute('SHOW max_connections')
+                    self.assertEqual(int(cursor.fetchone()[0]), 12)
 
     def test_invalid_max_connections_exit(self):
         with self.assertRaises(AssertionError):
             pgtest.PGTest(max_connections=3.5)
 
+    def test_postgres_opts_valid(self):
+        with pgtest.PGTest(postgres_opts='-c work_mem=1234kB') as pg:
+            with psycopg2.connect(**pg.dsn) as connection:
+                with connection.cursor() as cursor:
+                    cursor.execute('SHOW work_mem')
+                    self.assertEqual(cursor.fetchone()[0], '1234kB')
+
+    def test_invalid_postgres_opts_exit(self):
+        with self.assertRaises(AssertionError):
+            pgtest.PGTest(postgres_opts=['-c', 'work_mem=1234kB'])
+        with self.assertRaises(AssertionError):
+            pgtest.PGTest(postgres_opts=b'-c work_mem=1234kB')
+
 class TestPGTestNoParameters(unittest.TestCase, CustomAssertions):
 
     @classmethod
     def setUpClass(cls):
-        cls.pg_ctl_exe = pgtest.which('pg_ctl')
-        cls.pg = pgtest.PGTest()
-
-    @classmethod
-    def tearDownClass(cls):
-        cls.pg.close()
+        cls.pg = get_shared_pg()
 
     def test_port_valid(self):
         self.assertTrue(pgtest.is_valid_port(self.pg.port))
 
+    def test_port_released_to_server(self):
+        self.assertIsNone(self.pg._port_holder)
+
     def test_pg_ctl_valid(self):
-        self.assertIsNotNone(pgtest.which(self.pg.pg_ctl))
+        self.assertTrue(os.path.isabs(self.pg.pg_ctl))
+        self.assertTrue(pgtest.is_executable(self.pg.pg_ctl))
 
     def test_url_valid(self):
-        self.assertRegexMatch(r'postgresql://[\w]+@localhost:[0-9]+/[\w]+', self.pg.url)
+        self.assertRegexMatch(URL_RE, self.pg.url)
 
     def test_cluster_valid(self):
         self.assertTrue(pgtest.is_valid_cluster_dir(self.pg.cluster))
@@ -153,6 +256,12 @@ class TestPGTestNoParameters(unittest.TestCase, CustomAssertions):
     def test_cluster_running(self):
         self.assertTrue(pgtest.is_server_running(self.pg.cluster))
 
+    def test_cluster_copied_from_template(self):
+        template = pgtest._get_template_cluster(self.pg.pg_ctl, self.pg.username)
+        self.assertNotEqual(template, self.pg.cluster)
+        self.assertTrue(pgtest.is_valid_cluster_dir(template))
+        self.assertFalse(pgtest.is_server_running(template))
+
     @unittest.skipIf(sys.platform.startswith('win'), 'Unix only')
     def test_unix_listen_socket_dir_exists(self):
         self.assertDirExists(self.pg._listen_socket_dir)
@@ -160,44 +269,43 @@ class TestPGTestNoParameters(unittest.TestCase, CustomAssertions):
     def test_log_file_exists(self):
         self.assertFileExists(self.pg._log_file)
 
-    def test_cant_set_port(self):
-        with self.assertRaises(AttributeError):
-            self.pg.port = self.pg.port
+    def test_cant_set_attributes(self):
+        for attr in ('port', 'cluster', 'log_file', 'username', 'pg_ctl',
+                     'url'):
+            with self.subTest(attr=attr):
+                with self.assertRaises(AttributeError):
+                    setattr(self.pg, attr, getattr(self.pg, attr))
 
-    def test_cant_set_cluster(self):
-        with self.assertRaises(AttributeError):
-            self.pg.cluster = self.pg.cluster
 
-    def test_cant_set_log_file(self):
-        with self.assertRaises(AttributeError):
-            self.pg.log_file = self.pg.log_file
-
-    def test_cant_set_username(self):
-        with self.assertRaises(AttributeError):
-            self.pg.username = self.pg.username
-
-    def test_cant_set_pg_ctl(self):
-        with self.assertRaises(AttributeError):
-            self.pg.pg_ctl = self.pg.pg_ctl
-
-    def test_cant_set_url(self):
-        with self.assertRaises(AttributeError):
-            self.pg.url = self.pg.url
+class Test_is_valid_port(unittest.TestCase):
 
+    # Checking every port is slow and adds nothing over the boundaries, so
+    # check those and a sample from either side. Seeded so failures repeat
+    SAMPLE_SIZE = 50
 
-class Test_is_valid_port(unittest.TestCase):
+    def setUp(self):
+        self.rand = random.Random(0)
 
     def test_is_valid_port(self):
-        for i in range(1025, 65534):
-            self.assertTrue(pgtest.is_valid_port(i))
+        ports = [1025, 1026, 65533, 65534]
+        ports += self.rand.sample(range(1025, 65535), self.SAMPLE_SIZE)
+        self.assertEqual([p for p in ports if not pgtest.is_valid_port(p)], [])
 
     def test_is_not_valid_port_too_low(self):
-        for l in range(1024):
-            self.assertFalse(pgtest.is_valid_port(l))
+        ports = [0, 1, 1023, 1024]
+        ports += self.rand.sample(range(1025), self.SAMPLE_SIZE)
+        self.assertEqual([p for p in ports if pgtest.is_valid_port(p)], [])
 
     def test_is_not_valid_port_too_high(self):
-        for u in range(65535, 100000):
-            self.assertFalse(pgtest.is_valid_port(u))
+        ports = [65535, 65536, 99999]
+        ports += self.rand.sample(range(65535, 100000), self.SAMPLE_SIZE)
+        self.assertEqual([p for p in ports if pgtest.is_valid_port(p)], [])
+
+    @unittest.skipUnless(os.environ.get('SLOW_TESTS'), 'SLOW_TESTS not set')
+    def test_is_valid_port_exhaustive(self):
+        self.assertEqual([p for p in range(100000)
+                          if pgtest.is_valid_port(p) != (1024 < p < 65535)],
+                         [])
 
     def test_is_not_valid_port_neg(self):
         self.assertFalse(pgtest.is_valid_port(-1))
@@ -206,6 +314,23 @@ class Test_is_valid_port(unittest.TestCase):
         self.assertFalse(pgtest.is_valid_port('1234'))
 
 
+class Test_bind_unused_port(unittest.TestCase):
+
+    def test_bind_unused_port_is_valid(self):
+        for _ in range(10):
+            self.assertTrue(pgtest.is_valid_port(pgtest.bind_unused_port()))
+
+    # Refused connections are retried for about a second on Windows
+    @unittest.skipIf(sys.platform.startswith('win'), 'Unix only')
+    def test_bind_unused_port_is_unused(self):
+        for _ in range(10):
+            port = pgtest.bind_unused_port()
+            with closing(socket.socket(socket.AF_INET,
+                                       socket.SOCK_STREAM)) as sock:
+                self.assertIn(sock.connect_ex(('127.0.0.1', port)),
+                              (errno.ECONNREFUSED, errno.EADDRNOTAVAIL))
+
+
 class Test_is_valid_db_object_name(unittest.TestCase):
 
     def test_is_valid_db_object_name_is_valid(self):
@@ -214,11 +339,15 @@ class Test_is_valid_db_object_name(unittest.TestCase):
 
     def test_is_valid_db_object_name_is_not_valid(self):
         for c in r'`¬!"£$%^&*()+[]{};\'#:@~,./<>? ':
-            self.assertFalse(pgtest.is_valid_db_object_name(c))
+            with self.subTest(c=c):
+                self.assertFalse(pgtest.is_valid_db_object_name(c))
 
     def test_is_valid_db_object_name_blank_is_not_valid(self):
         self.assertFalse(pgtest.is_valid_db_object_name(''))
 
+    def test_is_valid_db_object_name_trailing_newline_is_not_valid(self):
+        self.assertFalse(pgtest.is_valid_db_object_name('postgres\n'))
+
     def test_is_valid_db_object_name_non_string_is_not_valid(self):
         with self.assertRaises(TypeError):
             for c in (1, 1.0, str):
@@ -231,18 +360,13 @@ class Test_is_valid_db_object_name(unittest.TestCase):
 class Test_is_valid_server_cluster(unittest.TestCase):
 
     @classmethod
-    def setUp(cls):
-        cls.pg_ctl_exe = pgtest.which('pg_ctl')
-        cls.temp_dir = tempfile.mkdtemp()
-        cls.curr_dir = os.path.dirname(__file__)
-        cls.data_dir = os.path.join(cls.temp_dir, 'data')
-        cmd = ('"{pg_ctl}" initdb -D "{cluster}" -o "-U postgres -A trust"'
-            ).format(pg_ctl=cls.pg_ctl_exe, cluster=cls.data_dir)
-        subprocess.check_output(cmd, shell=True)
+    def setUpClass(cls):
+        find_postgres()
 
-    @classmethod
-    def tearDown(cls):
-        shutil.rmtree(cls.temp_dir, ignore_errors=True)
+    def setUp(self):
+        self.temp_dir = make_temp_dir(self)
+        self.data_dir = os.path.join(self.temp_dir, 'data')
+        shutil.copytree(CLUSTER_TEMPLATE, self.data_dir)
 
     def test_is_not_valid_cluster_dir(self):
         self.assertFalse(pgtest.is_valid_cluster_dir(self.temp_dir))
@@ -253,63 +377,95 @@ class Test_is_valid_server_cluster(unittest.TestCase):
     def test_is_not_server_running(self):
         self.assertFalse(pgtest.is_server_running(self.data_dir))
 
+    @unittest.skipIf(sys.platform.startswith('win'), 'Unix only')
+    def test_is_not_server_running_stale_pid_file(self):
+        proc = subprocess.Popen([sys.executable, '-c', ''])
+        proc.wait()
+        with open(os.path.join(self.data_dir, 'postmaster.pid'), 'w') as handle:
+            handle.write('{}\n'.format(proc.pid))
+        self.assertFalse(pgtest.is_server_running(self.data_dir))
+
+
+class Test_bindir_version(unittest.TestCase):
+
+    def test_bindirs_newest_first(self):
+        bindirs = ['/usr/lib/postgresql/9.6/bin', '/usr/lib/postgresql/12/bin',
+                   '/usr/lib/postgresql/10/bin']
+        self.assertEqual(sorted(bindirs, key=pgtest._bindir_version,
+                                reverse=True),
+                         ['/usr/lib/postgresql/12/bin',
+                          '/usr/lib/postgresql/10/bin',
+                          '/usr/lib/postgresql/9.6/bin'])
+
+
+class Test_make_clone_file(unittest.TestCase):
+
+    def test_copytree_matches_source(self):
+        # Enough files that, where reflinks aren't supported, most are copied
+        # after the first failed clone
+        src = os.path.join(make_temp_dir(self), 'src')
+        os.makedirs(os.path.join(src, 'sub'))
+        files = {}
+        for i in range(5):
+            files['f{}'.format(i)] = (os.urandom(8192), 0o600)
+            files[os.path.join('sub', 'x{}'.format(i))] = (os.urandom(8192),
+                                                            0o755)
+        for name, (data, mode) in files.items():
+            with open(os.path.join(src, name), 'wb') as handle:
+                handle.write(data)
+            os.chmod(os.path.join(src, name), mode)
+
+        dst = os.path.join(make_temp_dir(self), 'dst')
+        shutil.copytree(src, dst, copy_function=pgtest._make_clone_file())
+        for name, (data, mode) in files.items():
+            with self.subTest(name=name):
+                path = os.path.join(dst, name)
+                with open(path, 'rb') as handle:
+                    self.assertEqual(handle.read(), data)
+                if not sys.platform.startswith('win'):
+                    self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), mode)
+
 
 class Test_which(unittest.TestCase):
 
     @unittest.skipIf(sys.platform.startswith('win'), 'Unix only')
     def test_unix_which_is_executable(self):
         if sys.platform.startswith('darwin'):
-            self.assertIn(pgtest.which('ping'), ('/sbin/ping', '/usr/sbin/ping'))
-        else:
-            self.assertIn(pgtest.which('ping'), ('/bin/ping', '/usr/bin/ping'))
-
-    @unittest.skipIf(sys.platform.startswith('win'), 'Unix only')
-    def testunix_which_path_is_executable(self):
-        if sys.platform.startswith('darwin'):
-            self.assertEqual(pgtest.which('/sbin/ping'), '/sbin/ping')
+            expected = ('/sbin/ping', '/usr/sbin/ping')
         else:
-            self.assertEqual(pgtest.which('/bin/ping'), '/bin/ping')
+            expected = ('/bin/ping', '/usr/bin/ping')
+        for name in ('ping', u'ping', expected[0]):
+            with self.subTest(name=name):
+                self.assertIn(pgtest.which(name), expected)
 
     @unittest.skipIf(sys.platform.startswith('win'), 'Unix only')
     def test_unix_which_is_not_executable(self):
         with self.assertRaises(FileNotFoundError):
             pgtest.which('doesnotexist')
 
-    def test_which_non_string(self):
-        with self.assertRaises(TypeError):
-            pgtest.which(1)
-
-    @unittest.skipIf(sys.platform.startswith('win'), 'Unix only')
-    def test_unix_which_unicode(self):
-        if sys.platform.startswith('darwin'):
-            self.assertIn(pgtest.which('ping'), ('/sbin/ping', '/usr/sbin/ping'))
-        else:
-            self.assertIn(pgtest.which('ping'), ('/bin/ping', '/usr/bin/ping'))
-
-    @unittest.skipUnless(sys.platform.startswith('win'), 'Windows only')
-    def test_windows_which_unicode(self):
-        self.assertEqual('C:\\Windows\\system32\\ping.exe'.lower(), pgtest.which(u'ping').lower())
-
     @unittest.skipUnless(sys.platform.startswith('win'), 'Windows only')
     def test_windows_which_is_executable(self):
-        self.assertEqual('C:\\Windows\\system32\\ping.exe'.lower(), pgtest.which('ping').lower())
-
-    @unittest.skipUnless(sys.platform.startswith('win'), 'Windows only')
-    def test_windows_which_with_extension_is_executable(self):
-        self.assertEqual('C:\\Windows\\system32\\ping.exe'.lower(), pgtest.which('ping.exe').lower())
-
-    @unittest.skipUnless(sys.platform.startswith('win'), 'Windows only')
-    def test_windows_which_path_is_executable(self):
-        self.assertEqual('C:\\Windows\\system32\\ping.exe'.lower(), pgtest.which('C:/Windows/system32/ping').lower())
-
-    @unittest.skipUnless(sys.platform.startswith('win'), 'Windows only')
-    def test_windows_which_path_with_extension_is_executable(self):
-        self.assertEqual('C:\\Windows\\system32\\ping.exe'.lower(), pgtest.which('C:/Windows/system32/ping.exe').lower())
+        expected = 'C:\\Windows\\system32\\ping.exe'.lower()
+        for name in ('ping', u'ping', 'ping.exe', 'C:/Windows/system32/ping',
+                     'C:/Windows/system32/ping.exe'):
+            with self.subTest(name=name):
+                self.assertEqual(expected, pgtest.which(name).lower())
 
     @unittest.skipUnless(sys.platform.startswith('win'), 'Windows only')
     def test_windows_which_is_not_executable(self):
-        self.assertEqual(None, pgtest.which('does not exist'))
+        self.assertIsNone(pgtest.which('does not exist'))
+
+    def test_which_non_string(self):
+        with self.assertRaises(TypeError):
+            pgtest.which(1)
 
+    def test_which_is_cached(self):
+        pgtest._clear_exe_cache()
+        python_exe = pgtest.which(sys.executable)
+        self.assertEqual(pgtest.which(sys.executable), python_exe)
+        self.assertEqual(pgtest.which.cache_info().hits, 1)
+        pgtest._clear_exe_cache()
+        self.assertEqual(pgtest.which.cache_info().currsize, 0)
 
 if __name__ == '__main__':
     unittest.main()